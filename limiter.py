@@ -21,7 +21,29 @@
 # Imported modules
 #
 
+import itertools
+import locale
+import logging
+import math
+import mmap
+import os
+import random
+import struct
+import threading
 import time
+import zlib
+
+# NumPy is optional, only used for the vectorized batch path
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Numba is optional, only used to JIT compile the step kernels
+try:
+    import numba
+except ImportError:
+    numba = None
 
 
 #--------------------------------------------------------------------------
@@ -30,6 +52,18 @@ import time
 #
 
 
+#
+# Record struct
+#
+# The algorithm 1 database value is a (rate, last, excesses, status) record,
+# we pack it into a single 21 byte buffer (float64, float64, int32, uint8)
+# rather than have the backend pickle a tuple of four boxed objects, which
+# slashes the serialization cost and the value payload size per request
+#
+_RECORD_STRUCT = struct.Struct('<ddiB')
+
+
+
 #
 # Limiter status
 #
@@ -70,6 +104,10 @@ _A1_EXTENDED_BLOCK_EXPIRATION = 21600
 # Expiration in seconds (1 hour)
 _A1_EXPIRATION = 3600
 
+# Whether there is a maximum excesses limit, precomputed so the hot
+# path does a single load rather than a compare against the constant
+_A1_HAS_EXCESS_LIMIT = (_A1_MAXIMUM_EXCESSES != -1)
+
 
 
 #
@@ -105,6 +143,159 @@ _A2_EXTENDED_BLOCK_EXPIRATION = (60 * 60 * 6)
 # Expiration in seconds (1 hour)
 _A2_EXPIRATION = 3600
 
+# Whether there is a maximum excesses limit, precomputed so the hot
+# path does a single load rather than a compare against the constant
+_A2_HAS_EXCESS_LIMIT = (_A2_MAXIMUM_EXCESSES != -1)
+
+# Number of shards to spread each client's records over, one hot client
+# saturating a single key becomes several cooler keys, each shard
+# enforcing a proportional slice of the limit at the cost of some
+# accuracy, disabled by default since a single key is accurate and
+# cheaper, raise it when one client's key becomes a measured hot spot
+_A2_SHARDS = 1
+
+# Suffix for the per-client block key used when sharding, and the record
+# stored under it, excesses and statuses are tracked per shard so an
+# extended block raised by one shard is recorded under the block key and
+# checked first, otherwise the other shards would keep serving a client
+# that is supposed to be blocked
+_A2_BLOCK_KEY_SUFFIX = ':blocked'
+_A2_BLOCK_RECORD = bytes((STATUS_EXTENDED_BLOCK,))
+
+# Per shard requests and allowance
+_A2_SHARD_REQUESTS = (_A2_REQUESTS / _A2_SHARDS)
+_A2_SHARD_ALLOWANCE = (_A2_ALLOWANCE / _A2_SHARDS)
+
+# Fixed point scale, the allowance is stored as an integer count of
+# milli-tokens and the times as integer milliseconds, which keeps the
+# hot path on integer arithmetic and narrows the stored record
+_A2_MILLI = 1000
+
+# Per shard requests and allowance in milli-tokens
+_A2_SHARD_REQUESTS_MT = int(_A2_SHARD_REQUESTS * _A2_MILLI)
+_A2_SHARD_ALLOWANCE_MT = int(_A2_SHARD_ALLOWANCE * _A2_MILLI)
+
+# Algorithm 2 record struct, a (allowance milli-tokens, last milliseconds,
+# excesses, status) record packed into 15 bytes (uint32, uint64, uint16,
+# uint8), the last time is kept at 64 bits so it never wraps
+_A2_RECORD_STRUCT = struct.Struct('<IQHB')
+
+
+
+#
+# Atomic increment scripts
+#
+# The get/set path does two round-trips to the database per request and
+# exposes a time-of-check-to-time-of-use race between concurrent workers
+# on the same client identifier, so when the database is a Redis client
+# we run the whole read-modify-write as a single Lua script instead,
+# doing the refill, decrement, excess counting, status derivation and
+# expiration atomically in one round-trip.
+#
+
+# Algorithm 1 increment script - KEYS[1] is the client identifier,
+# ARGV is (maximum rate, maximum excesses, expiration, extended block expiration),
+# returns (status, rate, excesses)
+#
+# The time comes from the Redis server clock, client monotonic clocks
+# have an arbitrary per-host epoch so a 'last' written by one host would
+# be garbage to another, the server clock is the one clock every
+# instance shares
+_A1_INCREMENT_RATE_SCRIPT = """
+local data = redis.call('HMGET', KEYS[1], 'rate', 'last', 'excesses', 'status')
+local rate = tonumber(data[1]) or 0
+local last = tonumber(data[2]) or 0
+local excesses = tonumber(data[3]) or 0
+local status = tonumber(data[4]) or 0
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + (tonumber(time[2]) / 1000000)
+local maximumRate = tonumber(ARGV[1])
+local maximumExcesses = tonumber(ARGV[2])
+local expiration = tonumber(ARGV[3])
+local extendedBlockExpiration = tonumber(ARGV[4])
+if status == 2 then
+    return {status, tostring(rate), excesses}
+end
+if last == 0 then
+    last = now
+end
+rate = (1 + rate) / ((now - last) + 1)
+if rate >= maximumRate then
+    if status == 0 then
+        excesses = excesses + 1
+    end
+    if maximumExcesses ~= -1 and excesses > maximumExcesses then
+        status = 2
+        expiration = extendedBlockExpiration
+    else
+        status = 1
+    end
+end
+redis.call('HMSET', KEYS[1], 'rate', rate, 'last', now, 'excesses', excesses, 'status', status)
+redis.call('EXPIRE', KEYS[1], expiration)
+return {status, tostring(rate), excesses}
+"""
+
+# Algorithm 2 increment script - KEYS[1] is the client identifier,
+# KEYS[2] is the per-client block key, ARGV is (allowance rate, requests,
+# maximum excesses, expiration, extended block expiration, propagate),
+# when propagate is 1 the block key is checked first and a new extended
+# block is recorded under it so every shard honors it,
+# returns (status, allowance, excesses)
+#
+# The time comes from the Redis server clock, client monotonic clocks
+# have an arbitrary per-host epoch so a 'last' written by one host would
+# be garbage to another, the server clock is the one clock every
+# instance shares
+_A2_INCREMENT_RATE_SCRIPT = """
+local data = redis.call('HMGET', KEYS[1], 'allowance', 'last', 'excesses', 'status')
+local allowance = tonumber(data[1]) or tonumber(ARGV[2])
+local last = tonumber(data[2]) or 0
+local excesses = tonumber(data[3]) or 0
+local status = tonumber(data[4]) or 0
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + (tonumber(time[2]) / 1000000)
+local allowanceRate = tonumber(ARGV[1])
+local requests = tonumber(ARGV[2])
+local maximumExcesses = tonumber(ARGV[3])
+local expiration = tonumber(ARGV[4])
+local extendedBlockExpiration = tonumber(ARGV[5])
+local propagate = tonumber(ARGV[6])
+if status == 2 then
+    return {status, tostring(allowance), excesses}
+end
+if propagate == 1 and redis.call('EXISTS', KEYS[2]) == 1 then
+    return {2, tostring(allowance), excesses}
+end
+if last == 0 then
+    last = now
+end
+allowance = allowance + ((now - last) * allowanceRate)
+if allowance > requests then
+    allowance = requests
+end
+if allowance < 1 then
+    if status == 0 then
+        excesses = excesses + 1
+    end
+    if maximumExcesses ~= -1 and excesses > maximumExcesses then
+        status = 2
+        expiration = extendedBlockExpiration
+        if propagate == 1 then
+            redis.call('SET', KEYS[2], '2', 'EX', extendedBlockExpiration)
+        end
+    else
+        status = 1
+    end
+else
+    status = 0
+    allowance = allowance - 1
+end
+redis.call('HMSET', KEYS[1], 'allowance', allowance, 'last', now, 'excesses', excesses, 'status', status)
+redis.call('EXPIRE', KEYS[1], expiration)
+return {status, tostring(allowance), excesses}
+"""
+
 
 
 #
@@ -118,11 +309,74 @@ _A3_ALGORITHM_ID = 3
 
 
 
+#
+# Algorithm 4
+#
+# Sliding window log
+#
+# Keeps a log of the request times within the window and caps the number
+# of requests in the window exactly, which stays accurate under bursts
+# where algorithm 2's token bucket can admit up to twice the limit
+# around a window boundary
+#
+
+# Algorithm ID
+_A4_ALGORITHM_ID = 4
+
+# Number of requests allowed within the window
+_A4_REQUESTS = 10
+
+# Window in seconds
+_A4_WINDOW = 5.0
+
+# Algorithm 4 increment script - KEYS[1] is the client identifier,
+# ARGV is (window, requests, nonce), the nonce makes the log member
+# unique so concurrent requests landing on the same clock tick are all
+# counted, returns 1 if the request is over the limit and 0 if not
+#
+# The time comes from the Redis server clock, client monotonic clocks
+# have an arbitrary per-host epoch so scores written by one host would
+# be garbage to another, the server clock is the one clock every
+# instance shares
+_A4_INCREMENT_RATE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + (tonumber(time[2]) / 1000000)
+local window = tonumber(ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now - window)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 1
+end
+redis.call('ZADD', KEYS[1], now, now .. ':' .. ARGV[3])
+redis.call('PEXPIRE', KEYS[1], math.ceil(window * 1000))
+return 0
+"""
+
+
+
 # Select which algorithm we want to use
 _ALGORITHM_ID = _A3_ALGORITHM_ID
 
 
 
+#
+# Write-back buffer
+#
+# When enabled each limiter defers its database writes into an in-process
+# buffer that coalesces repeated updates to the same key, and a flusher
+# thread sends the newest values along periodically, trading a bounded
+# staleness window for far fewer database writes under bursty per-client
+# traffic. Deferred writes cannot be compared against the database so
+# enabling this disables the compare-and-set path.
+#
+
+# Whether the write-back buffer is enabled
+_WRITE_BACK = False
+
+# Write-back flush interval in seconds (10 milliseconds)
+_WRITE_BACK_FLUSH_INTERVAL = 0.01
+
+
+
 #--------------------------------------------------------------------------
 #
 # Setup
@@ -146,6 +400,494 @@ logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
 # Logger
 logger = logging.getLogger()
 
+# Sequence used to make the algorithm 4 log members unique, concurrent
+# requests can land on the same cached clock tick
+_A4_SEQUENCE = itertools.count()
+
+# Per-thread preallocated record buffers, the write paths pack records
+# into these in place with pack_into rather than allocating a fresh
+# buffer for every request
+_THREAD_BUFFERS = threading.local()
+
+# Whether debug logging is enabled, cached so the hot path can skip the
+# logging call and its argument tuple entirely when debug is off,
+# recompute this if the logging configuration changes at runtime
+_DEBUG_ENABLED = logger.isEnabledFor(logging.DEBUG)
+
+
+#--------------------------------------------------------------------------
+#
+#   Function:   _A1_step
+#
+#   Purpose:    Algorithm 1 step kernel
+#
+#               The pure rate arithmetic is kept in this module level
+#               function so Numba can JIT compile it to native code when
+#               available, see below
+#
+#   Parameters: rate        the current rate
+#               delta       the time elapsed since the rate was last incremented
+#               excesses    the number of times the maximum rate was exceeded
+#               status      the status
+#
+#   Returns:    (rate, excesses, status)
+#
+def _A1_step (rate, delta, excesses, status):
+
+    # Clamp the elapsed time at zero, a stored record can carry a 'last'
+    # ahead of the local clock (another host's monotonic epoch, or a
+    # record persisted across a reboot) and a negative delta would
+    # divide by zero or inflate the rate
+    if delta < 0:
+        delta = 0
+
+    # Calculate the new rate
+    rate = (1 + rate) / (delta + 1)
+
+    # Maximum rate was exceeded
+    if rate >= _A1_MAXIMUM_RATE:
+
+        # We newly exceeded the rate so we increment the excesses
+        if status == STATUS_NO_BLOCK:
+            excesses += 1
+
+        # Set the status depending on whether the excesses exceeded the maximum excesses or not
+        if _A1_HAS_EXCESS_LIMIT and excesses > _A1_MAXIMUM_EXCESSES:
+            status = STATUS_EXTENDED_BLOCK
+        else:
+            status = STATUS_SHORT_BLOCK
+
+    # Return the new rate, excesses and status
+    return (rate, excesses, status)
+
+
+
+#--------------------------------------------------------------------------
+#
+#   Function:   _A2_step
+#
+#   Purpose:    Algorithm 2 step kernel
+#
+#               The pure token bucket arithmetic is kept in this module
+#               level function so Numba can JIT compile it to native code
+#               when available, see below
+#
+#   Parameters: allowance   the allowance in milli-tokens
+#               delta       the time elapsed since the rate was last incremented, in milliseconds
+#               excesses    the number of times the maximum rate was exceeded
+#               status      the status
+#
+#   Returns:    (allowance, excesses, status)
+#
+def _A2_step (allowance, delta, excesses, status):
+
+    # Clamp the elapsed time at zero, a stored record can carry a 'last'
+    # ahead of the local clock (another host's monotonic epoch, or a
+    # record persisted across a reboot) and a negative delta would
+    # drive the allowance negative, which does not fit the unsigned
+    # record field
+    if delta < 0:
+        delta = 0
+
+    # Calculate the new allowance in milli-tokens
+    allowance += (delta * _A2_SHARD_ALLOWANCE_MT) // _A2_MILLI
+
+    # Cap the allowance
+    if allowance > _A2_SHARD_REQUESTS_MT:
+        allowance = _A2_SHARD_REQUESTS_MT
+
+    # Check the allowance, less than one whole token means we have none
+    if allowance < _A2_MILLI:
+
+        # We newly exceeded the rate so we increment the excesses
+        if status == STATUS_NO_BLOCK:
+            excesses += 1
+
+        # Set the status depending on whether the excesses exceeded the maximum excesses or not
+        if _A2_HAS_EXCESS_LIMIT and excesses > _A2_MAXIMUM_EXCESSES:
+            status = STATUS_EXTENDED_BLOCK
+        else:
+            status = STATUS_SHORT_BLOCK
+
+    # We still have some allowance so set the status and decrement the allowance
+    else:
+        status = STATUS_NO_BLOCK
+        allowance -= _A2_MILLI
+
+    # Return the new allowance, excesses and status
+    return (allowance, excesses, status)
+
+
+
+# JIT compile the step kernels to native code if Numba is available,
+# caching the compiled kernels on disk across runs
+if numba is not None:
+    _A1_step = numba.njit(cache=True, fastmath=True)(_A1_step)
+    _A2_step = numba.njit(cache=True, fastmath=True)(_A2_step)
+
+
+
+#--------------------------------------------------------------------------
+#
+#   Class:      _ClockCache
+#
+#   Purpose:    Cached monotonic clock
+#
+#               Calling time.time() on every request can dominate execution
+#               time on some hosts, and rate limiting only needs millisecond
+#               accuracy, so we cache time.monotonic() in a class attribute
+#               refreshed by a daemon thread and read it as a plain attribute.
+#
+#               We use time.monotonic() rather than time.time() so that
+#               clock steps backward cannot corrupt the (now - last) delta.
+#
+class _ClockCache (object):
+
+
+    # Current time, refreshed by the refresh thread
+    now = time.monotonic()
+
+    # Refresh interval in seconds (1 millisecond)
+    _REFRESH_INTERVAL = 0.001
+
+    # Startup lock and refresh thread
+    _lock = threading.Lock()
+    _thread = None
+
+
+    #--------------------------------------------------------------------------
+    #
+    #   Method:         start
+    #
+    #   Purpose:        Start the refresh thread if it is not already running
+    #
+    #   Parameters:
+    #
+    #   Exceptions:
+    #
+    @classmethod
+    def start (cls):
+
+        # Guard thread startup with the lock so we only spawn one thread
+        with cls._lock:
+            if cls._thread is None:
+                cls._thread = threading.Thread(target=cls._refresh, daemon=True)
+                cls._thread.start()
+
+
+
+    #--------------------------------------------------------------------------
+    #
+    #   Method:         _refresh
+    #
+    #   Purpose:        Refresh the cached time, runs in the refresh thread
+    #
+    #   Parameters:
+    #
+    #   Exceptions:
+    #
+    @classmethod
+    def _refresh (cls):
+
+        # Refresh the cached time forever
+        while True:
+            cls.now = time.monotonic()
+            time.sleep(cls._REFRESH_INTERVAL)
+
+
+
+
+
+#--------------------------------------------------------------------------
+#
+#   Class:      SharedMemoryBackend
+#
+#   Purpose:    Shared memory database backend
+#
+#               A fixed size open addressed hash table over an mmap'ed
+#               file, for single host deployments where a network trip to
+#               the database is pure waste, a get or set is a memory
+#               operation instead of a round-trip.
+#
+#               Writes within a process are serialized by a lock, and every
+#               slot carries a generation counter that is odd while a write
+#               is in flight, so readers in other processes retry rather
+#               than see a torn record. Writer processes are not
+#               synchronized with each other, so run a single writer
+#               process or shard the key space between them.
+#
+class SharedMemoryBackend (object):
+
+
+    # Maximum key and value lengths in bytes
+    _MAXIMUM_KEY_LENGTH = 64
+    _MAXIMUM_VALUE_LENGTH = 128
+
+    # Slot header struct - (generation, key hash, key length, value length, expiry)
+    _SLOT_HEADER_STRUCT = struct.Struct('<IIHHd')
+
+    # Slot size in bytes, the header followed by the key and the value
+    _SLOT_SIZE = (_SLOT_HEADER_STRUCT.size + _MAXIMUM_KEY_LENGTH + _MAXIMUM_VALUE_LENGTH)
+
+    # Maximum times a reader re-reads a slot that will not settle, an
+    # in-flight write lasts a handful of instructions so any honest
+    # writer finishes well within this, a slot still unsettled after
+    # this many reads was abandoned by a dead writer
+    _MAXIMUM_READ_RETRIES = 64
+
+
+    #--------------------------------------------------------------------------
+    #
+    #   Method:         __init__
+    #
+    #   Purpose:        Constructor
+    #
+    #   Parameters:     filePath    the backing file path
+    #                   slots       the number of slots in the table
+    #                   create      True to start with a clean table, zeroing
+    #                               any previous contents of the backing file,
+    #                               False to attach to a table another process
+    #                               created
+    #
+    #   Exceptions:     ValueError  Missing or invalid file path
+    #                   ValueError  Missing or invalid slots
+    #
+    def __init__ (self, filePath, slots=65536, create=True):
+
+        # Check the parameters
+        if not filePath:
+            raise ValueError('Missing or invalid file path')
+        if slots <= 0:
+            raise ValueError('Missing or invalid slots')
+
+
+        # The number of slots
+        self._slots = slots
+
+        # Open the backing file, size it to the table and map it,
+        # truncating away any previous contents first so a fresh process
+        # starts with a clean table, stale records carry the previous
+        # boot's monotonic clock epoch and a writer that died mid-write
+        # leaves a slot that will never settle
+        fileDescriptor = os.open(filePath, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if create:
+                os.ftruncate(fileDescriptor, 0)
+            os.ftruncate(fileDescriptor, slots * self._SLOT_SIZE)
+            self._map = mmap.mmap(fileDescriptor, slots * self._SLOT_SIZE)
+        finally:
+            os.close(fileDescriptor)
+
+        # Write lock, serializes writers within this process
+        self._lock = threading.Lock()
+
+
+
+    #--------------------------------------------------------------------------
+    #
+    #   Method:         get
+    #
+    #   Purpose:        Get the value for this key
+    #
+    #   Parameters:     key         the key
+    #
+    #   Exceptions:     ValueError  Missing or invalid key
+    #
+    #   Returns:        the value, or None if the key is absent or expired
+    #
+    def get (self, key):
+
+        # Check the parameters
+        if not key:
+            raise ValueError('Missing or invalid key')
+
+
+        # Encode the key and look up its slot
+        key = key.encode('utf-8') if isinstance(key, str) else key
+        entry = self._find(key)
+
+        # Return the value if the slot holds one
+        return entry[1] if entry else None
+
+
+
+    #--------------------------------------------------------------------------
+    #
+    #   Method:         set
+    #
+    #   Purpose:        Set the value for this key
+    #
+    #   Parameters:     key         the key
+    #                   value       the value
+    #                   expiration  the expiration (in seconds)
+    #
+    #   Exceptions:     ValueError  Missing or invalid key
+    #                   ValueError  Key or value too long
+    #                   ValueError  Table is full
+    #
+    def set (self, key, value, expiration=0):
+
+        # Check the parameters
+        if not key:
+            raise ValueError('Missing or invalid key')
+
+
+        # Encode the key and store it under the write lock
+        key = key.encode('utf-8') if isinstance(key, str) else key
+        with self._lock:
+            self._store(key, bytes(value), expiration)
+
+
+
+    #--------------------------------------------------------------------------
+    #
+    #   Method:         compareAndSet
+    #
+    #   Purpose:        Set the value for this key only if the current value
+    #                   is the expected one, the compare and the set happen
+    #                   under the write lock so a concurrent writer in this
+    #                   process cannot interleave
+    #
+    #   Parameters:     key         the key
+    #                   expected    the expected current value, None for absent
+    #                   value       the value
+    #                   expiration  the expiration (in seconds)
+    #
+    #   Exceptions:     ValueError  Missing or invalid key
+    #                   ValueError  Key or value too long
+    #                   ValueError  Table is full
+    #
+    #   Returns:        True if the value was set, False if the current value
+    #                   did not match
+    #
+    def compareAndSet (self, key, expected, value, expiration=0):
+
+        # Check the parameters
+        if not key:
+            raise ValueError('Missing or invalid key')
+
+
+        # Encode the key, then compare and store under the write lock
+        key = key.encode('utf-8') if isinstance(key, str) else key
+        with self._lock:
+
+            # Compare the current value against the expected one
+            entry = self._find(key)
+            current = entry[1] if entry else None
+            if current != expected:
+                return False
+
+            # Store the value
+            self._store(key, bytes(value), expiration)
+            return True
+
+
+
+    #--------------------------------------------------------------------------
+    #
+    #   Method:         _find
+    #
+    #   Purpose:        Find the slot for this key
+    #
+    #   Parameters:     key         the key (encoded)
+    #
+    #   Returns:        (slot offset, value) if the key is present and not
+    #                   expired, otherwise None
+    #
+    def _find (self, key):
+
+        # Probe linearly from the key's home slot
+        keyHash = zlib.crc32(key)
+        headerStruct = self._SLOT_HEADER_STRUCT
+        for probe in range(self._slots):
+            offset = ((keyHash + probe) % self._slots) * self._SLOT_SIZE
+
+            # Read the slot, re-reading while a write is in flight (odd
+            # generation) or the generation changed under us (torn read),
+            # bounded so a writer that died mid-write, leaving an odd
+            # generation behind in the map, cannot hang readers forever,
+            # a slot that never settles is garbage and the key is
+            # reported absent
+            for attempt in range(self._MAXIMUM_READ_RETRIES):
+                generation, slotHash, keyLength, valueLength, expiry = headerStruct.unpack_from(self._map, offset)
+                if generation & 1:
+                    continue
+                body = self._map[offset + headerStruct.size : offset + self._SLOT_SIZE]
+                if headerStruct.unpack_from(self._map, offset)[0] == generation:
+                    break
+            else:
+                return None
+
+            # An empty slot ends the probe, the key is absent
+            if keyLength == 0:
+                return None
+
+            # Check the key, skipping expired entries
+            if slotHash == keyHash and body[:keyLength] == key:
+                if expiry and expiry <= time.monotonic():
+                    return None
+                return (offset, body[self._MAXIMUM_KEY_LENGTH : self._MAXIMUM_KEY_LENGTH + valueLength])
+
+        # The table was fully probed
+        return None
+
+
+
+    #--------------------------------------------------------------------------
+    #
+    #   Method:         _store
+    #
+    #   Purpose:        Store the value for this key, caller holds the write lock
+    #
+    #   Parameters:     key         the key (encoded)
+    #                   value       the value
+    #                   expiration  the expiration (in seconds)
+    #
+    #   Exceptions:     ValueError  Key or value too long
+    #                   ValueError  Table is full
+    #
+    def _store (self, key, value, expiration):
+
+        # Check the lengths
+        if len(key) > self._MAXIMUM_KEY_LENGTH:
+            raise ValueError('Key too long')
+        if len(value) > self._MAXIMUM_VALUE_LENGTH:
+            raise ValueError('Value too long')
+
+
+        # Probe linearly from the key's home slot for the key's slot or
+        # the first empty or expired slot
+        keyHash = zlib.crc32(key)
+        headerStruct = self._SLOT_HEADER_STRUCT
+        now = time.monotonic()
+        for probe in range(self._slots):
+            offset = ((keyHash + probe) % self._slots) * self._SLOT_SIZE
+            generation, slotHash, keyLength, valueLength, expiry = headerStruct.unpack_from(self._map, offset)
+
+            # Keep probing past other live keys
+            if keyLength != 0 and not (slotHash == keyHash and self._map[offset + headerStruct.size : offset + headerStruct.size + keyLength] == key):
+                if not expiry or expiry > now:
+                    continue
+
+            # A dead writer can leave an odd generation behind, bump it
+            # so the in-flight generation below is odd and the final one
+            # even again
+            if generation & 1:
+                generation += 1
+
+            # Write the slot, the generation is odd while the write is in
+            # flight so readers retry rather than see a torn record
+            headerStruct.pack_into(self._map, offset, generation + 1, keyHash, len(key), len(value), (now + expiration) if expiration else 0)
+            self._map[offset + headerStruct.size : offset + headerStruct.size + len(key)] = key
+            valueOffset = offset + headerStruct.size + self._MAXIMUM_KEY_LENGTH
+            self._map[valueOffset : valueOffset + len(value)] = value
+            headerStruct.pack_into(self._map, offset, generation + 2, keyHash, len(key), len(value), (now + expiration) if expiration else 0)
+            return
+
+        # Every slot is taken by a live key
+        raise ValueError('Shared memory backend is full')
+
+
 
 #--------------------------------------------------------------------------
 #
@@ -153,25 +895,87 @@ logger = logging.getLogger()
 #
 #   Purpose:    Limiter class
 #
+#               Constructing a Limiter returns the subclass for the selected
+#               algorithm, so the algorithm choice is made once at creation
+#               and there is no per-request dispatch
+#
 class Limiter (object):
 
 
+    # One slot per attribute, a slot load is an array index rather than an
+    # instance dictionary probe, and there is no per-instance dictionary
+    __slots__ = ('_database', '_A1_scriptSHA', '_A2_scriptSHA', '_A4_scriptSHA', '_useCompareAndSet', '_pending')
+
+
+    #--------------------------------------------------------------------------
+    #
+    #   Method:         __new__
+    #
+    #   Purpose:        Create the limiter, specializing a direct Limiter()
+    #                   construction to the subclass for the selected algorithm
+    #
+    #   Parameters:
+    #
+    #   Exceptions:     ValueError          No algorithm was selected
+    #
+    def __new__ (cls):
+
+        # Specialize to the subclass for the selected algorithm,
+        # otherwise raise an error
+        if cls is Limiter:
+            cls = _ALGORITHM_CLASSES.get(_ALGORITHM_ID)
+            if cls is None:
+                raise ValueError('No algorithm was selected')
+
+        # Create the instance
+        return object.__new__(cls)
+
+
+
     #--------------------------------------------------------------------------
     #
     #   Method:         __init__
     #
     #   Purpose:        Constructor
     #
-    #   Parameters:    
+    #   Parameters:
     #
-    #   Exceptions:    
+    #   Exceptions:
     #
     def __init__(self):
 
-        # Initialize the database we use to store rate data, 
-        # replace this with something worthy
+        # Initialize the database we use to store rate data, replace this
+        # with something worthy, a Redis client for multi-host deployments
+        # or a SharedMemoryBackend for single host ones
         self._database = None
 
+        # Load the atomic increment scripts if the database supports them
+        # (i.e. it is a Redis client), caching the script SHAs, otherwise
+        # we fall back to the get/set path
+        self._A1_scriptSHA = None
+        self._A2_scriptSHA = None
+        self._A4_scriptSHA = None
+        if self._database is not None and hasattr(self._database, 'script_load'):
+            self._A1_scriptSHA = self._database.script_load(_A1_INCREMENT_RATE_SCRIPT)
+            self._A2_scriptSHA = self._database.script_load(_A2_INCREMENT_RATE_SCRIPT)
+            self._A4_scriptSHA = self._database.script_load(_A4_INCREMENT_RATE_SCRIPT)
+
+        # Use compare-and-set for the read-modify-write if the database
+        # supports it, this keeps concurrent workers updating the same
+        # client identifier lock-free, a collision just retries
+        self._useCompareAndSet = hasattr(self._database, 'compareAndSet')
+
+        # Initialize the write-back buffer and start the flusher thread if
+        # write-back is enabled, the compare-and-set path is turned off
+        # since deferred writes cannot be compared against the database
+        self._pending = {}
+        if _WRITE_BACK:
+            self._useCompareAndSet = False
+            threading.Thread(target=self._flushPendingLoop, daemon=True).start()
+
+        # Start the cached clock refresh thread
+        _ClockCache.start()
+
         
 
     #--------------------------------------------------------------------------
@@ -183,35 +987,108 @@ class Limiter (object):
     #   Parameters:     clientIdentifier    client identifier
     #
     #   Exceptions:     ValueError          Missing or invalid client identifier
-    #                   ValueError          No algorithm was selected
     #
     #   Returns:        Limiter status
     #
     def incrementRate (self, clientIdentifier):
 
+        # Implemented by the algorithm subclasses
+        raise NotImplementedError
+
+
+
+    #--------------------------------------------------------------------------
+    #
+    #   Method:         incrementRateBatch
+    #
+    #   Purpose:        Increment the rate for a batch of client identifiers
+    #
+    #   Parameters:     clientIdentifiers   sequence of client identifiers
+    #
+    #   Exceptions:     ValueError          Missing or invalid client identifiers
+    #
+    #   Returns:        list of limiter statuses, parallel to the client identifiers
+    #
+    def incrementRateBatch (self, clientIdentifiers):
+
         # Check the parameters
-        if not clientIdentifier:
-            raise ValueError('Missing or invalid client identifier')
+        if not clientIdentifiers:
+            raise ValueError('Missing or invalid client identifiers')
 
-    
-        # Route to the appropriate algorithm, otherwise raise an error
-        if _ALGORITHM_ID == _A1_ALGORITHM_ID:
-            return self._A1_incrementRate(clientIdentifier)
 
-        elif _ALGORITHM_ID == _ALGORITHM_ID_A2:
-            return self._A2_incrementRate(clientIdentifier)
+        # Increment one at a time, algorithm subclasses with a vectorized
+        # form override this
+        return [self.incrementRate(clientIdentifier) for clientIdentifier in clientIdentifiers]
 
-        elif _ALGORITHM_ID == _A3_ALGORITHM_ID:
-            return STATUS_NO_BLOCK
 
-        else:
-            raise ValueError('No algorithm was selected')
+
+    #--------------------------------------------------------------------------
+    #
+    #   Method:         _flushPendingLoop
+    #
+    #   Purpose:        Flush the write-back buffer periodically, runs in
+    #                   the flusher thread
+    #
+    #   Parameters:
+    #
+    #   Exceptions:
+    #
+    def _flushPendingLoop (self):
+
+        # Flush forever
+        while True:
+            time.sleep(_WRITE_BACK_FLUSH_INTERVAL)
+            self._flushPending()
 
 
 
     #--------------------------------------------------------------------------
     #
-    #   Method:         _A1_incrementRate
+    #   Method:         _flushPending
+    #
+    #   Purpose:        Flush the write-back buffer, sending the newest
+    #                   value for each key to the database
+    #
+    #   Parameters:
+    #
+    #   Exceptions:
+    #
+    def _flushPending (self):
+
+        # Drain the buffer one entry at a time with popitem, which is
+        # atomic under the GIL, request threads keep inserting into the
+        # same dictionary while we drain so there is no iteration to
+        # invalidate and no swap to race against, repeated updates to a
+        # key have already coalesced to the newest value, the KeyError
+        # guards against another thread draining the last entry between
+        # the emptiness check and the pop
+        pending = self._pending
+        database = self._database
+        while pending:
+            try:
+                key, (value, expiration) = pending.popitem()
+            except KeyError:
+                break
+            database.set(key, value, expiration=expiration)
+
+
+
+#--------------------------------------------------------------------------
+#
+#   Class:      _A1Limiter
+#
+#   Purpose:    Limiter subclass for algorithm 1
+#
+class _A1Limiter (Limiter):
+
+
+    # No additional attributes
+    __slots__ = ()
+
+
+    #--------------------------------------------------------------------------
+    #
+    #   Method:         incrementRate
     #
     #   Purpose:        Increment the rate - algoritm 1
     #
@@ -221,13 +1098,32 @@ class Limiter (object):
     #
     #   Returns:        Limiter status
     #
-    def _A1_incrementRate (self, clientIdentifier):
+    # The trailing keyword defaults bind the configuration and helpers at
+    # definition time so the hot path loads them as locals instead of
+    # doing a module dictionary lookup for each one per request
+    def incrementRate (self, clientIdentifier,
+            _recordStruct=_RECORD_STRUCT, _step=_A1_step, _clockCache=_ClockCache,
+            _expiration=_A1_EXPIRATION, _extendedBlockExpiration=_A1_EXTENDED_BLOCK_EXPIRATION):
+
+        # Check the parameters
+        if not clientIdentifier:
+            raise ValueError('Missing or invalid client identifier')
+
+
+        # Run the increment atomically in the database if we loaded the
+        # script, one round-trip and no time-of-check-to-time-of-use race
+        if self._A1_scriptSHA:
+            status, rate, excesses = self._database.evalsha(self._A1_scriptSHA, 1, clientIdentifier,
+                    _A1_MAXIMUM_RATE, _A1_MAXIMUM_EXCESSES,
+                    _A1_EXPIRATION, _A1_EXTENDED_BLOCK_EXPIRATION)
+            return int(status)
+
 
         #
         # Value fields:
         #
         #   rate        -   the current rate
-        #   last        -   the last time.time() at which the rate was incremented
+        #   last        -   the last cached clock time at which the rate was incremented
         #   excesses    -   the number of times the maximum rate was exceeded
         #   status      -   the status
         #
@@ -236,44 +1132,52 @@ class Limiter (object):
         rate, last, excesses, status = (0, 0, 0, STATUS_NO_BLOCK)
 
                 
-        # Get the data from the database
-        data = self._get(clientIdentifier)
-
-        # Unpack the data, checking the status for a permanent block, return here if that is the case
+        # Cache the database locally for faster access
+        database = self._database
+
+        # Get the packed record, checking the write-back buffer first so we
+        # see our own deferred writes, the status is the last byte of the
+        # record so an already blocked client is turned away by peeking at
+        # it, no unpacking or arithmetic, under attack this is the dominant
+        # path, otherwise unpack the record
+        pending = self._pending.get(clientIdentifier) if _WRITE_BACK else None
+        data = pending[0] if pending else database.get(clientIdentifier)
         if data:
-            rate, last, excesses, status = data[0], data[1], data[2], data[3]
-            if status == STATUS_EXTENDED_BLOCK:
-                return status
-
-
-        # Get the time now
-        now = time.time()
-
-        # Calculate the new rate
-        rate = (1 + rate) / ((now - last) + 1)
-
-        # Maximum rate was exceeded
-        if rate >= _A1_MAXIMUM_RATE:
-            
-            # We newly exceeded the rate so we increment the excesses
-            if status == STATUS_NO_BLOCK:
-                excesses += 1
-            
-            # Set the status depending on whether the excesses exceeded the maximum excesses or not
-            if _A1_MAXIMUM_EXCESSES != -1 and excesses > _A1_MAXIMUM_EXCESSES:
-                status = STATUS_EXTENDED_BLOCK
-            else:
-                status = STATUS_SHORT_BLOCK
-            
+            if data[-1] == STATUS_EXTENDED_BLOCK:
+                return STATUS_EXTENDED_BLOCK
+            rate, last, excesses, status = _recordStruct.unpack(data)
 
-        # Set the expiration, override with extended block expiration if needed
-        expiration = _A1_EXPIRATION
-        if status == STATUS_EXTENDED_BLOCK:
-            expiration = _A1_EXTENDED_BLOCK_EXPIRATION
 
-        # Store the data in the database
-        self._set(self.clientIdentifier, (rate, now, excesses, status), expiration)
-        logger.debug('Rate.increment - rate: [%s], last: [%s], excesses: [%s], status: [%s].', (rate, last, excesses, status))
+        # Get the time now from the cached clock
+        now = _clockCache.now
+
+        # Calculate the new rate, excesses and status with the step kernel,
+        # the elapsed time is computed once here
+        rate, excesses, status = _step(rate, now - last, excesses, status)
+
+
+        # Set the expiration, override with extended block expiration if needed
+        expiration = _expiration
+        if status is STATUS_EXTENDED_BLOCK:
+            expiration = _extendedBlockExpiration
+
+        # Pack the record into the per-thread buffer, packing in place
+        # avoids allocating a fresh buffer per request, backends copy the
+        # value out before returning so sharing the buffer is safe
+        try:
+            buffer = _THREAD_BUFFERS.A1
+        except AttributeError:
+            buffer = _THREAD_BUFFERS.A1 = memoryview(bytearray(_RECORD_STRUCT.size))
+        _recordStruct.pack_into(buffer, 0, rate, now, excesses, status)
+
+        # Store the packed record, the write-back buffer gets a snapshot
+        # since the per-thread buffer is reused before the flush
+        if _WRITE_BACK:
+            self._pending[clientIdentifier] = (bytes(buffer), expiration)
+        else:
+            database.set(clientIdentifier, buffer, expiration=expiration)
+        if _DEBUG_ENABLED:
+            logger.debug('Rate.increment - rate: [%s], last: [%s], excesses: [%s], status: [%s].', rate, last, excesses, status)
 
 
         # Return the status
@@ -281,9 +1185,23 @@ class Limiter (object):
 
 
 
+
+#--------------------------------------------------------------------------
+#
+#   Class:      _A2Limiter
+#
+#   Purpose:    Limiter subclass for algorithm 2
+#
+class _A2Limiter (Limiter):
+
+
+    # No additional attributes
+    __slots__ = ()
+
+
     #--------------------------------------------------------------------------
     #
-    #   Method:         _A2_incrementRate
+    #   Method:         incrementRate
     #
     #   Purpose:        Increment the rate - algoritm 2
     #
@@ -293,123 +1211,390 @@ class Limiter (object):
     #
     #   Returns:        Limiter status
     #
-    def _A2_incrementRate (self, clientIdentifier):
+    # The trailing keyword defaults bind the configuration and helpers at
+    # definition time so the hot path loads them as locals instead of
+    # doing a module dictionary lookup for each one per request
+    def incrementRate (self, clientIdentifier,
+            _recordStruct=_A2_RECORD_STRUCT, _step=_A2_step, _initialAllowance=_A2_SHARD_ALLOWANCE_MT,
+            _clockCache=_ClockCache,
+            _expiration=_A2_EXPIRATION, _extendedBlockExpiration=_A2_EXTENDED_BLOCK_EXPIRATION):
+
+        # Check the parameters
+        if not clientIdentifier:
+            raise ValueError('Missing or invalid client identifier')
+
+
+        # Shard the client identifier, each shard enforces its slice of
+        # the limit so the shards add up to the configured limit, an
+        # extended block raised by any shard lands on the per-client
+        # block key so the other shards honor it
+        blockKey = None
+        if _A2_SHARDS > 1:
+            blockKey = clientIdentifier + _A2_BLOCK_KEY_SUFFIX
+            clientIdentifier = '%s:%d' % (clientIdentifier, random.randrange(_A2_SHARDS))
+
+
+        # Run the increment atomically in the database if we loaded the
+        # script, one round-trip and no time-of-check-to-time-of-use race
+        if self._A2_scriptSHA:
+            status, allowance, excesses = self._database.evalsha(self._A2_scriptSHA, 2, clientIdentifier, blockKey or clientIdentifier,
+                    _A2_SHARD_ALLOWANCE, _A2_SHARD_REQUESTS, _A2_MAXIMUM_EXCESSES,
+                    _A2_EXPIRATION, _A2_EXTENDED_BLOCK_EXPIRATION, 1 if blockKey else 0)
+            return int(status)
+
 
         #
         # Fields:
         #
-        #   allowance   -   the allowance
-        #   last        -   the last time.time() at which the rate was incremented
+        #   allowance   -   the allowance in milli-tokens
+        #   last        -   the last cached clock time at which the rate was incremented, in milliseconds
         #   excesses    -   the number of times the maximum rate was exceeded
         #   status      -   the status
         #
 
-        # Allowance, last, excesses and status, initial values
-        allowance, last, excesses, status = (_A2_ALLOWANCE, 0, 0, STATUS_NO_BLOCK)
+        # Cache the database locally for faster access
+        database = self._database
+
+        # Check the per-client block key first when sharding, the shard
+        # we are about to land on may not be the one that blocked the client
+        if blockKey:
+            pending = self._pending.get(blockKey) if _WRITE_BACK else None
+            if pending or database.get(blockKey):
+                return STATUS_EXTENDED_BLOCK
+
+        # Retry the read-modify-write until it lands, when the database
+        # supports compare-and-set concurrent workers updating the same
+        # client identifier stay lock-free and a collision just retries,
+        # otherwise we make a single pass with a plain set
+        while True:
+
+            # Allowance, last, excesses and status, initial values
+            allowance, last, excesses, status = (_initialAllowance, 0, 0, STATUS_NO_BLOCK)
+
+            # Get the packed record, checking the write-back buffer first so
+            # we see our own deferred writes, the status is the last byte of
+            # the record so an already blocked client is turned away by
+            # peeking at it, no unpacking or arithmetic, under attack this
+            # is the dominant path, otherwise unpack the record
+            pending = self._pending.get(clientIdentifier) if _WRITE_BACK else None
+            raw = pending[0] if pending else database.get(clientIdentifier)
+            if raw:
+                if raw[-1] == STATUS_EXTENDED_BLOCK:
+                    return STATUS_EXTENDED_BLOCK
+                allowance, last, excesses, status = _recordStruct.unpack(raw)
+
+
+            # Get the time now from the cached clock, in milliseconds
+            now = int(_clockCache.now * _A2_MILLI)
+
+            # Calculate the new allowance, excesses and status with the step
+            # kernel, the elapsed time is computed once here
+            allowance, excesses, status = _step(allowance, now - last, excesses, status)
+
+
+            # Set the expiration, override with extended block expiration if needed
+            expiration = _expiration
+            if status is STATUS_EXTENDED_BLOCK:
+                expiration = _extendedBlockExpiration
+
+            # Pack the record into the per-thread buffer, packing in place
+            # avoids allocating a fresh buffer per request, backends copy
+            # the value out before returning so sharing the buffer is safe
+            try:
+                buffer = _THREAD_BUFFERS.A2
+            except AttributeError:
+                buffer = _THREAD_BUFFERS.A2 = memoryview(bytearray(_A2_RECORD_STRUCT.size))
+            _recordStruct.pack_into(buffer, 0, allowance, now, excesses, status)
+
+            # Store the packed record, the compare-and-set only succeeds if
+            # the record is unchanged since we read it, so a concurrent
+            # update means we go again, and the write-back buffer gets a
+            # snapshot since the per-thread buffer is reused before the flush
+            if self._useCompareAndSet:
+                if not database.compareAndSet(clientIdentifier, raw, buffer, expiration=expiration):
+                    continue
+            elif _WRITE_BACK:
+                self._pending[clientIdentifier] = (bytes(buffer), expiration)
+            else:
+                database.set(clientIdentifier, buffer, expiration=expiration)
 
-    
-        # Get the data from the database
-        data = self._get(clientIdentifier)
+            # Propagate a new extended block to the per-client block key
+            # so every shard turns the client away
+            if blockKey and status is STATUS_EXTENDED_BLOCK:
+                if _WRITE_BACK:
+                    self._pending[blockKey] = (_A2_BLOCK_RECORD, _extendedBlockExpiration)
+                else:
+                    database.set(blockKey, _A2_BLOCK_RECORD, expiration=_extendedBlockExpiration)
+
+            if _DEBUG_ENABLED:
+                logger.debug('Rate.increment - allowance: [%s], last: [%s], excesses: [%s], status: [%s].', allowance, last, excesses, status)
+
+
+            # Return the status
+            return status
 
-        # Unpack the data, checking the status for a permanent block, return here if that is the case
-        if data:
-            allowance, last, excesses, status = data[0], data[1], data[2], data[3]
-            if status == STATUS_EXTENDED_BLOCK:
-                return status
-
-
-        # Get the time now
-        now = time.time()
-
-        # Calculate the new allowance
-        allowance += (now - last) * _A2_ALLOWANCE
-
-        # Cap the allowance
-        if allowance > _A2_REQUESTS:
-            allowance = _A2_REQUESTS
-
-        # Check the allowance, less than 1 means we have none
-        if allowance < 1.0:
-            
-            # We newly exceeded the rate so we increment the excesses
-            if status == STATUS_NO_BLOCK:
-                excesses += 1
-            
-            # Set the status depending on whether the excesses exceeded the maximum excesses or not
-            if _A2_MAXIMUM_EXCESSES != -1 and excesses > _A2_MAXIMUM_EXCESSES:
-                status = STATUS_EXTENDED_BLOCK
-            else:
-                status = STATUS_SHORT_BLOCK
 
-        # We still have some allowance so set the status and decrement the allowance
+
+    #--------------------------------------------------------------------------
+    #
+    #   Method:         incrementRateBatch
+    #
+    #   Purpose:        Increment the rate for a batch of client identifiers
+    #
+    #                   A gateway typically sees many client identifiers in one
+    #                   event-loop tick and handling them one at a time pays a
+    #                   full interpreter round-trip each, so when NumPy is
+    #                   available we fetch all the records, compute the token
+    #                   bucket update over the whole batch at once and write the
+    #                   records back, otherwise we fall back to incrementing
+    #                   one at a time.
+    #
+    #   Parameters:     clientIdentifiers   sequence of client identifiers
+    #
+    #   Exceptions:     ValueError          Missing or invalid client identifiers
+    #
+    #   Returns:        list of limiter statuses, parallel to the client identifiers
+    #
+    def incrementRateBatch (self, clientIdentifiers):
+
+        # Check the parameters
+        if not clientIdentifiers:
+            raise ValueError('Missing or invalid client identifiers')
+
+
+        # Fall back to incrementing one at a time if NumPy is not available
+        if numpy is None:
+            return Limiter.incrementRateBatch(self, clientIdentifiers)
+
+
+        # Shard the client identifiers, each shard enforces its slice of
+        # the limit so the shards add up to the configured limit, an
+        # extended block raised by any shard lands on the per-client
+        # block key so the other shards honor it
+        blockKeys = None
+        if _A2_SHARDS > 1:
+            blockKeys = [clientIdentifier + _A2_BLOCK_KEY_SUFFIX for clientIdentifier in clientIdentifiers]
+            clientIdentifiers = ['%s:%d' % (clientIdentifier, random.randrange(_A2_SHARDS)) for clientIdentifier in clientIdentifiers]
+
+
+        # Fetch the current records into parallel arrays, one per field,
+        # missing clients get the initial record, the raw records are kept
+        # for the compare-and-set on the way back out
+        count = len(clientIdentifiers)
+        allowances = numpy.empty(count, dtype=numpy.int64)
+        lasts = numpy.empty(count, dtype=numpy.int64)
+        excesses = numpy.empty(count, dtype=numpy.int32)
+        statuses = numpy.empty(count, dtype=numpy.int32)
+        raws = [None] * count
+        database = self._database
+        for index, clientIdentifier in enumerate(clientIdentifiers):
+            if blockKeys:
+                blockKey = blockKeys[index]
+                pending = self._pending.get(blockKey) if _WRITE_BACK else None
+                if pending or database.get(blockKey):
+                    allowances[index], lasts[index], excesses[index], statuses[index] = (0, 0, 0, STATUS_EXTENDED_BLOCK)
+                    continue
+            pending = self._pending.get(clientIdentifier) if _WRITE_BACK else None
+            data = pending[0] if pending else database.get(clientIdentifier)
+            raws[index] = data
+            allowances[index], lasts[index], excesses[index], statuses[index] = _A2_RECORD_STRUCT.unpack(data) if data else (_A2_SHARD_ALLOWANCE_MT, 0, 0, STATUS_NO_BLOCK)
+
+        # Clients already under an extended block are left untouched
+        extendedBlocks = (statuses == STATUS_EXTENDED_BLOCK)
+
+        # Get the time now from the cached clock, in milliseconds
+        now = int(_ClockCache.now * _A2_MILLI)
+
+        # Calculate the new allowances over the whole batch, capping them,
+        # the elapsed times are clamped at zero since a stored 'last' can
+        # be ahead of the local clock
+        allowances = numpy.minimum(_A2_SHARD_REQUESTS_MT, allowances + ((numpy.maximum(0, now - lasts) * _A2_SHARD_ALLOWANCE_MT) // _A2_MILLI))
+
+        # Check the allowances, less than one whole token means we have none
+        belows = (allowances < _A2_MILLI)
+
+        # Newly exceeded clients get their excesses incremented
+        excesses += (belows & (statuses == STATUS_NO_BLOCK)).astype(numpy.int32)
+
+        # Set the statuses depending on whether the excesses exceeded the
+        # maximum excesses or not, and decrement the remaining allowances
+        if _A2_HAS_EXCESS_LIMIT:
+            extendeds = (belows & (excesses > _A2_MAXIMUM_EXCESSES))
         else:
-            status = STATUS_NO_BLOCK
-            allowance -= 1.0
+            extendeds = numpy.zeros(count, dtype=bool)
+        statuses = numpy.where(extendeds, STATUS_EXTENDED_BLOCK, numpy.where(belows, STATUS_SHORT_BLOCK, STATUS_NO_BLOCK))
+        allowances = numpy.where(belows, allowances, allowances - _A2_MILLI)
+
+        # Restore the statuses of clients already under an extended block
+        statuses = numpy.where(extendedBlocks, STATUS_EXTENDED_BLOCK, statuses)
+
+
+        # Store the updated records in the database, skipping clients that
+        # were already under an extended block, when the backend supports
+        # compare-and-set each record only lands if it is unchanged since
+        # we read it, a collision means a concurrent increment got there
+        # first so that one client is redone with the scalar step kernel
+        # rather than overwritten
+        useCompareAndSet = self._useCompareAndSet
+        for index, clientIdentifier in enumerate(clientIdentifiers):
+            if extendedBlocks[index]:
+                continue
+            status = int(statuses[index])
+            expiration = _A2_EXTENDED_BLOCK_EXPIRATION if status == STATUS_EXTENDED_BLOCK else _A2_EXPIRATION
+            record = _A2_RECORD_STRUCT.pack(int(allowances[index]), now, int(excesses[index]), status)
+            if useCompareAndSet:
+                raw = raws[index]
+                while not database.compareAndSet(clientIdentifier, raw, record, expiration=expiration):
+                    raw = database.get(clientIdentifier)
+                    if raw and raw[-1] == STATUS_EXTENDED_BLOCK:
+                        status = STATUS_EXTENDED_BLOCK
+                        break
+                    allowance, last, excess, status = _A2_RECORD_STRUCT.unpack(raw) if raw else (_A2_SHARD_ALLOWANCE_MT, 0, 0, STATUS_NO_BLOCK)
+                    allowance, excess, status = _A2_step(allowance, now - last, excess, status)
+                    expiration = _A2_EXTENDED_BLOCK_EXPIRATION if status == STATUS_EXTENDED_BLOCK else _A2_EXPIRATION
+                    record = _A2_RECORD_STRUCT.pack(allowance, now, excess, status)
+                statuses[index] = status
+            elif _WRITE_BACK:
+                self._pending[clientIdentifier] = (record, expiration)
+            else:
+                database.set(clientIdentifier, record, expiration=expiration)
+            if blockKeys and statuses[index] == STATUS_EXTENDED_BLOCK:
+                if _WRITE_BACK:
+                    self._pending[blockKeys[index]] = (_A2_BLOCK_RECORD, _A2_EXTENDED_BLOCK_EXPIRATION)
+                else:
+                    database.set(blockKeys[index], _A2_BLOCK_RECORD, expiration=_A2_EXTENDED_BLOCK_EXPIRATION)
 
 
-        # Set the expiration, override with extended block expiration if needed
-        expiration = _A2_EXPIRATION
-        if status == STATUS_EXTENDED_BLOCK:
-            expiration = _A2_EXTENDED_BLOCK_EXPIRATION
+        # Return the statuses
+        return [int(status) for status in statuses]
 
-        # Store the data in the database
-        self._set(clientIdentifier, (rate, now, excesses, status), expiration)
-        logger.debug('Rate.increment - rate: [%s], last: [%s], excesses: [%s], status: [%s].', (rate, last, excesses, status))
 
 
-        # Return the status
-        return status
-    
-    
-    
+#--------------------------------------------------------------------------
+#
+#   Class:      _A3Limiter
+#
+#   Purpose:    Limiter subclass for algorithm 3, no rate limit
+#
+class _A3Limiter (Limiter):
+
+
+    # No additional attributes
+    __slots__ = ()
+
+
     #--------------------------------------------------------------------------
     #
-    #   Method:         _get
+    #   Method:         incrementRate
     #
-    #   Purpose:        Get the value for this key
+    #   Purpose:        Increment the rate - algoritm 3, no rate limit
     #
-    #   Parameters:     key         the key  
+    #   Parameters:     clientIdentifier    client identifier
     #
-    #   Exceptions:     ValueError  Missing or invalid key
+    #   Exceptions:     ValueError          Missing or invalid client identifier
     #
-    def _get(self, key):
+    #   Returns:        Limiter status
+    #
+    def incrementRate (self, clientIdentifier):
 
         # Check the parameters
-        if not key:
-            raise ValueError('Missing or invalid key')
+        if not clientIdentifier:
+            raise ValueError('Missing or invalid client identifier')
 
 
-        # Get the value for this key
-        value = self._database.get(key)
+        # No rate limit
+        return STATUS_NO_BLOCK
 
-        # Return the value
-        return value
 
 
+#--------------------------------------------------------------------------
+#
+#   Class:      _A4Limiter
+#
+#   Purpose:    Limiter subclass for algorithm 4, sliding window log
+#
+class _A4Limiter (Limiter):
+
+
+    # No additional attributes
+    __slots__ = ()
+
 
     #--------------------------------------------------------------------------
     #
-    #   Method:         _set
+    #   Method:         incrementRate
     #
-    #   Purpose:        Set the value for this key
+    #   Purpose:        Increment the rate - algoritm 4, sliding window log
     #
-    #   Parameters:     key         the key  
-    #                   value       the value  
-    #                   expiration  the expiration (in seconds) 
+    #   Parameters:     clientIdentifier    client identifier
     #
-    #   Exceptions:     ValueError  Missing or invalid key
+    #   Exceptions:     ValueError          Missing or invalid client identifier
     #
-    def _set(self, key, value, expiration=0):
+    #   Returns:        Limiter status
+    #
+    def incrementRate (self, clientIdentifier):
 
         # Check the parameters
-        if not key:
-            raise ValueError('Missing or invalid key')
+        if not clientIdentifier:
+            raise ValueError('Missing or invalid client identifier')
 
 
-        # Store the value for this key, setting expiration
-        value = self._database.set(key, value, expiration=expiration)
-        
-        
+        # Cache the database locally for faster access
+        database = self._database
+
+        # Get the time now from the cached clock
+        now = _ClockCache.now
+
+
+        # Run the increment atomically in the database if we loaded the
+        # script, the sorted set is pruned, checked and extended in one
+        # round-trip
+        if self._A4_scriptSHA:
+            status = database.evalsha(self._A4_scriptSHA, 1, clientIdentifier,
+                    _A4_WINDOW, _A4_REQUESTS, '%d:%d' % (os.getpid(), next(_A4_SEQUENCE)))
+            return STATUS_SHORT_BLOCK if int(status) else STATUS_NO_BLOCK
+
+
+        # Get the packed log of request times, checking the write-back
+        # buffer first so we see our own deferred writes, and prune the
+        # times that have slid out of the window
+        pending = self._pending.get(clientIdentifier) if _WRITE_BACK else None
+        raw = pending[0] if pending else database.get(clientIdentifier)
+        horizon = now - _A4_WINDOW
+        times = [entry for entry in struct.unpack('<%dd' % (len(raw) // 8), raw) if entry > horizon] if raw else []
+
+        # The window is full so the request is over the limit
+        if len(times) >= _A4_REQUESTS:
+            return STATUS_SHORT_BLOCK
+
+        # Log this request and store the packed log back, deferring it to
+        # the write-back buffer when that is enabled
+        times.append(now)
+        log = struct.pack('<%dd' % len(times), *times)
+        if _WRITE_BACK:
+            self._pending[clientIdentifier] = (log, math.ceil(_A4_WINDOW))
+        else:
+            database.set(clientIdentifier, log, expiration=math.ceil(_A4_WINDOW))
+
+
+        # Return the status
+        return STATUS_NO_BLOCK
+
+
+
+#--------------------------------------------------------------------------
+#
+# Algorithm ID to limiter subclass, used by Limiter.__new__ to specialize
+# construction to the selected algorithm
+#
+
+_ALGORITHM_CLASSES = {
+    _A1_ALGORITHM_ID: _A1Limiter,
+    _ALGORITHM_ID_A2: _A2Limiter,
+    _A3_ALGORITHM_ID: _A3Limiter,
+    _A4_ALGORITHM_ID: _A4Limiter,
+}
+
 
 #--------------------------------------------------------------------------
 